@@ -7,13 +7,13 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from api.deps.apikey import api_key_dep
 from api.router import router as router_v1
-from core.settings import Settings
+from core.settings import get_settings
 
 logging.basicConfig(format="%(asctime)s %(module)-15s %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-settings = Settings()
+settings = get_settings()
 description = "TON Smart Contracts Indexer. Nominator pools, V2."
 app = FastAPI(
     title="TON SC Indexer V2" if not settings.api_title else settings.api_title,
@@ -15,11 +15,11 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from api import crud, schemas
 from core.connections import SessionMaker_Result as SessionMaker
-from core.settings import Settings
+from core.settings import get_settings
 from core.utils import address_to_raw, addr_hash_wc0_parse, hash_to_b64, hex_to_int
 from handlers.new_nominator_pool import parse_pool
 
-settings = Settings()
+settings = get_settings()
 router = APIRouter()
 
 # toncenter api v3 settings
@@ -1,6 +1,7 @@
 from typing import List, Optional
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
 from sqlalchemy.types import BigInteger, Enum, Integer, String
 
@@ -26,7 +27,7 @@ class Account(Base):
     __tablename__ = "accounts"
 
     account_id = mapped_column(BigInteger, primary_key=True, autoincrement=True)
-    account = mapped_column(String)
+    account = mapped_column(String, unique=True)  # upserted by address
     account_type = mapped_column(AccountType)
     balance = mapped_column(BigInteger)
     updated_utime = mapped_column(Integer)  # timestamp
@@ -116,4 +117,26 @@ class Nominator(Base):
     )
     balance = mapped_column(BigInteger)
     pending_balance = mapped_column(BigInteger)
-    subaccount = relationship("SubAccount", back_populates="nominator")
\ No newline at end of file
+    subaccount = relationship("SubAccount", back_populates="nominator")
+
+
+# Bulk writes.
+#   Small batches go as a single executemany insert,
+# bigger ones through asyncpg COPY (binary, one round-trip).
+COPY_THRESHOLD = 100
+
+
+async def bulk_copy(session: AsyncSession, model, rows: List[dict], columns: List[str]):
+    if len(rows) <= COPY_THRESHOLD:
+        await session.execute(insert(model), rows)
+        return
+
+    await session.flush()  # raw COPY doesn't autoflush pending objects
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        model.__tablename__,
+        records=[tuple(row[column] for column in columns) for row in rows],
+        columns=columns,
+        schema_name=model.__table__.schema,
+    )
@@ -1,20 +1,79 @@
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from uuid import uuid4
 
-from .settings import settings
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 
-engine_origin = create_async_engine(
-    url=settings.origin_dsn,
-    echo=False,
-    pool_size=8,
+from .settings import Settings, settings
+
+
+def make_engine(
+    dsn: str,
+    pool_size: int,
+    max_overflow: int,
+    server_settings: dict[str, str] | None = None,
+    settings: Settings = settings,
+) -> AsyncEngine:
+    """
+    Async engine for either db. `settings.pgbouncer_mode` picks how it
+    talks to the server:
+
+    | pgbouncer_mode | prepared statements         | startup settings              |
+    |----------------|-----------------------------|-------------------------------|
+    | "" (direct)    | cached per connection       | application_name, jit, extras |
+    | "session"      | cached per connection       | application_name              |
+    | "transaction"  | off, server conn may change | application_name              |
+
+    The pool never pre-pings: the ping holds a server connection behind
+    pgbouncer. pgbouncer rejects unknown startup parameters, so behind it
+    set jit and the `server_settings` extras on the db role instead.
+    """
+    startup = {"application_name": "sc-indexer"}
+    if not settings.pgbouncer_mode:
+        # jit warm-up costs more than it saves on short queries
+        startup["jit"] = "off"
+        startup.update(server_settings or {})
+
+    connect_args = {"server_settings": startup}
+    if settings.pgbouncer_mode == "transaction":
+        connect_args["statement_cache_size"] = 0
+        connect_args["prepared_statement_cache_size"] = 0
+        connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    else:
+        # asyncpg per-connection LRU of prepared statements
+        connect_args["statement_cache_size"] = 1024
+        # sqlalchemy's cache of asyncpg prepared statement objects
+        connect_args["prepared_statement_cache_size"] = 256
+
+    return create_async_engine(
+        url=dsn,
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=False,
+        # pgbouncer may drop idle server connections under us
+        pool_recycle=60 if settings.pgbouncer_mode else -1,
+        connect_args=connect_args,
+    )
+
+
+# every running handler holds at most one session of each db,
+# so pools are sized by the handlers concurrency
+engine_origin = make_engine(
+    settings.origin_dsn,
+    pool_size=settings.max_at_once,
+    max_overflow=0,
+    # let the server prefetch pages of the big scans, set once per connection
+    server_settings={"effective_io_concurrency": str(settings.origin_io_concurrency)},
 )
 
-engine_result = create_async_engine(
-    url=settings.result_dsn,
-    echo=False,
-    pool_size=20,
+# the api serves its requests from this engine too, so it keeps
+# overflow connections for request bursts
+engine_result = make_engine(
+    settings.result_dsn,
+    pool_size=settings.max_at_once,
+    max_overflow=10,
 )
 
-SessionMaker_Result = async_sessionmaker(bind=engine_result)
-SessionMaker_Origin = async_sessionmaker(bind=engine_origin)
+SessionMaker_Result = async_sessionmaker(bind=engine_result, expire_on_commit=False)
+SessionMaker_Origin = async_sessionmaker(bind=engine_origin, expire_on_commit=False)
 
 __all__ = ["SessionMaker_Origin", "SessionMaker_Result"]
@@ -3,9 +3,11 @@ from core.settings import settings
 
 class LocalDB:
     def __init__(self):
-        self.conn = sqlite3.connect(settings.localdb_file)
+        # written from a worker thread, see main.run
+        self.conn = sqlite3.connect(settings.localdb_file, check_same_thread=False)
         self._create_table()
         self.index_second = self.read()
+        self._written_second = self.index_second
 
     def _create_table(self):
         with self.conn:
@@ -18,8 +20,12 @@ class LocalDB:
         return result[0] if result else 0
 
     def write(self):
+        index_second = self.index_second
+        if index_second == self._written_second:
+            return  # nothing changed, skip the disk write
         with self.conn:
             self.conn.execute("INSERT OR REPLACE INTO index_data (key, value) VALUES (?, ?)",
-                              ("index_second", self.index_second))
+                              ("index_second", index_second))
+        self._written_second = index_second
 
 localdb = LocalDB()
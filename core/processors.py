@@ -15,11 +15,10 @@ class CallHandlerArgs(NamedTuple):
 async def call_handler(
     args: CallHandlerArgs,
 ):
-    if args.code_hash in handlers:
-        handler_function = handlers[args.code_hash]
-        await handler_function(args.handler_args)
-    else:
-        pass
+    handler_function = handlers.get(args.code_hash)
+    if handler_function is None:
         logger.error(
             f"Handler not found for code hash: {args.code_hash}",
         )
+        return
+    await handler_function(args.handler_args)
@@ -1,5 +1,7 @@
 import os
+from functools import lru_cache
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 DOTENV = os.path.join(os.getcwd(), ".env")
@@ -14,6 +16,15 @@ class Settings(BaseSettings):
     db_result_name: str = ""
     result_cluster_addr: str = "localhost:5432"
     localdb_file: str = "index-data.db"
+    pgbouncer_mode: str = ""  # "", "session" or "transaction"
+    max_at_once: int = 9  # concurrent handlers, also the size of db pools
+    origin_io_concurrency: int = 256  # prefetch depth for origin db scans
+    # run several indexers, each on its own share of accounts
+    # (give every one a separate localdb_file)
+    shards_count: int = 1
+    shard_index: int = 0
+    # create a partial index for the handled code hashes in origin db on start
+    create_origin_index: bool = False
 
     api_root_path: str = ""
     api_title: str = ""
@@ -28,7 +39,22 @@ class Settings(BaseSettings):
     def result_dsn(self) -> str:
         return f"postgresql+asyncpg://{self.db_user}:{self.db_password}@{self.result_cluster_addr}/{self.db_result_name}"
 
+    @model_validator(mode="after")
+    def check_shard(self) -> "Settings":
+        # out of range values would silently index nothing or everything
+        if self.shards_count < 1:
+            raise ValueError("shards_count must be at least 1")
+        if not 0 <= self.shard_index < self.shards_count:
+            raise ValueError("shard_index must be in [0, shards_count)")
+        return self
+
     model_config = SettingsConfigDict(env_file=DOTENV, env_prefix="SCI_")
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # parses env and .env once per process
+    return Settings()
+
+
+settings = get_settings()
@@ -150,6 +150,13 @@ def addr_hash_wc0_parse(src: Slice) -> Address | None:
     return addr_hash_parse(src, 0)
 
 
+def addr_hash_wc0_raw_parse(src) -> str:
+    # raw upper-case form, same as addr_hash_wc0_parse(src).to_str(False).upper()
+    # without building an Address. the key is bits: bitarray or "0101..."
+    bits = src if isinstance(src, str) else src.to01()
+    return f"0:{int(bits, 2):064X}"
+
+
 def bool_value_parse(src: Slice) -> bool:
     return bool(src.load_bit())
 
@@ -161,4 +168,3 @@ def coins_value_parse(src: Slice) -> int:
 def empty_parse(src: Slice) -> int:
     return 1
 
-
@@ -4,34 +4,54 @@ With accounting.
 https://github.com/ton-blockchain/nominator-pool/
 """
 
-from typing import NamedTuple
 import asyncio
+from bisect import bisect_right
+from functools import lru_cache
+from typing import NamedTuple
 import aiometer
 import base64
 import json
-import math
 from hashlib import sha256
-from pprint import pprint
 
 from loguru import logger
 from pytoniq.liteclient import BlockIdExt, LiteClient
 from pytoniq_core.boc import Address, Cell, Slice
 from pytoniq_core.boc.hashmap import HashMap
-from sqlalchemy import and_, delete, or_, select, text
+from sqlalchemy import Row, and_, delete, or_, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
-
-from contracts_db.database import Account, Booking, Nominator, NominatorPool, SubAccount
-from core.settings import settings
-from core.utils import addr_hash_wc0_parse, empty_parse, nanostr
-from handlers.handler_types import DBSession, HandlerArgs
+from sqlalchemy.orm import Bundle
+
+from contracts_db.database import (
+    Account,
+    Booking,
+    Nominator,
+    NominatorPool,
+    SubAccount,
+    bulk_copy,
+)
+from core.utils import addr_hash_wc0_raw_parse, empty_parse, nanostr
+from handlers.handler_types import HandlerArgs
 from mainnet_db.database import (
-    Block,
     Message,
     MessageContent,
     Transaction,
+    get_mc_blocks,
+    stream,
 )
 
+ELECTOR_ADDR = "-1:3333333333333333333333333333333333333333333333333333333333333333"
+
+# opcodes of messages to pool we care about. the origin db stores
+# opcode as signed int32, so recover_stake_ok is kept in both forms
+OP_COMMENT = 0
+OP_RECOVER_STAKE_OK = 0xF96F7324
+RECOVER_STAKE_OK_OPCODES = (OP_RECOVER_STAKE_OK, OP_RECOVER_STAKE_OK - 2**32)
+# first byte of deposit / withdraw comments
+COMMENT_DEPOSIT = ord("d")
+COMMENT_WITHDRAW = ord("w")
+
+
 def nominator_value_parse(src: Slice) -> tuple[int, int]:
     # nominator#_ deposit:Coins pending_deposit:Coins = Nominator;
     deposit = src.load_coins() or 0
@@ -39,6 +59,23 @@ def nominator_value_parse(src: Slice) -> tuple[int, int]:
     return deposit, pending_deposit
 
 
+@lru_cache(maxsize=4096)
+def parse_body_op(body: str) -> tuple[int | None, int | None]:
+    # (op, first byte of a comment). deposit/withdraw comments are
+    # the same few bodies over and over, so they are decoded once
+    body_boc = Cell.from_boc(body)[0].begin_parse()
+    try:
+        op = body_boc.load_uint(32)
+    except:
+        return None, None
+    if op != OP_COMMENT:
+        return op, None
+    try:
+        return op, body_boc.load_uint(8)
+    except:
+        return op, None
+
+
 def parse_pool(data: Cell):
     # pool_data#_ state:uint8 nominators_count:uint16
     #             stake_amount_sent:Coins validator_amount:Coins
@@ -100,14 +137,24 @@ async def handle_nominator_pool(
 
     # use it to clean data if pool cannot be processed
     async def delete_pool_with_nominators():
-        account_to_delete = await result_conn.execute(select(Account).filter(Account.account == pool_address_str))
-        account_to_delete = account_to_delete.scalars().first()
-        if account_to_delete:
-            await result_conn.delete(account_to_delete)
-            await result_conn.commit()
-            logger.warning(f"Account {pool_address_str} was deleted")
-        else:
+        account_id = await result_conn.scalar(
+            select(Account.account_id).filter(Account.account == pool_address_str)
+        )
+        if account_id is None:
             logger.warning(f"Account {pool_address_str} not found in db to delete")
+            return
+        # children first, by key: deleting the orm object would load every
+        # subaccount, nominator and booking of the pool just to cascade
+        subaccount_ids = select(SubAccount.subaccount_id).filter(
+            SubAccount.parent_account_id == account_id
+        )
+        await result_conn.execute(delete(Booking).where(Booking.subaccount_id.in_(subaccount_ids)))
+        await result_conn.execute(delete(Nominator).where(Nominator.subaccount_id.in_(subaccount_ids)))
+        await result_conn.execute(delete(SubAccount).where(SubAccount.parent_account_id == account_id))
+        await result_conn.execute(delete(NominatorPool).where(NominatorPool.account_id == account_id))
+        await result_conn.execute(delete(Account).where(Account.account_id == account_id))
+        await result_conn.commit()
+        logger.warning(f"Account {pool_address_str} was deleted")
         # query = delete(Nominator).filter_by(pool_address=pool_address_str)
         # await result_conn.execute(query)
         # query = delete(NominatorPool).filter_by(account=pool_address_str)
@@ -151,36 +198,37 @@ async def handle_nominator_pool(
     ) = parse_pool(data)
 
     # first, update the pool data because it may be empty later
-    query = (
-        select(Account, NominatorPool)
-        .select_from(Account)
-        .join(NominatorPool, NominatorPool.account_id == Account.account_id)
-        .filter(Account.account == pool_address_str)
-    )
-
-    res = (await result_conn.execute(query)).all()
+    # (upserts in a single transaction, no select beforehand)
+    async with result_conn.begin():
+        pool_id_in_accouts = (
+            await result_conn.execute(
+                insert(Account)
+                .values(
+                    account=pool_address_str,
+                    account_type="nominator_pool",
+                    balance=balance,
+                )
+                .on_conflict_do_update(
+                    index_elements=[Account.account],
+                    set_={"balance": balance},
+                )
+                .returning(Account.account_id)
+            )
+        ).scalar_one()
 
-    if res:
-        pool_account, pool = res[0]
-    else:
-        pool_account = Account(
-            account=pool_address_str,
-            account_type="nominator_pool",
-            balance=balance,
+        pool_values = {
+            "validator_amount": validator_amount,
+            "stake_amount_sent": stake_amount_sent,
+            "nominators_count": nominators_count,
+        }
+        await result_conn.execute(
+            insert(NominatorPool)
+            .values(account_id=pool_id_in_accouts, **pool_values)
+            .on_conflict_do_update(
+                index_elements=[NominatorPool.account_id],
+                set_=pool_values,
+            )
         )
-        result_conn.add(pool_account)
-        await result_conn.flush()
-        pool = NominatorPool(account_id=pool_account.account_id)
-
-    pool_account.balance = balance
-    pool.validator_amount = validator_amount
-    pool.stake_amount_sent = stake_amount_sent
-    pool.nominators_count = nominators_count
-
-    pool_id_in_accouts = pool.account_id
-
-    result_conn.add(pool)
-    await result_conn.commit()
     logger.info("Updated pool " + pool_address_str)
 
     # then additional value checks
@@ -192,7 +240,7 @@ async def handle_nominator_pool(
         nominators_dict = HashMap.parse(
             dict_cell=nominators_cell.begin_parse(),
             key_length=256,
-            key_deserializer=addr_hash_wc0_parse,
+            key_deserializer=addr_hash_wc0_raw_parse,
             value_deserializer=nominator_value_parse,
         )
         if not nominators_dict:
@@ -229,9 +277,20 @@ async def handle_nominator_pool(
     # probably, it needs some sorting. so we first compile data in dicts
     # and at the end sort and write into db
 
+    # only the message columns used below, as a bundle: rows still read
+    # like msg.created_lt, without building and hydrating Message objects
+    msg_columns = Bundle(
+        "msg",
+        Message.created_lt,
+        Message.created_at,
+        Message.source,
+        Message.destination,
+        Message.value,
+        Message.tx_hash,
+    )
     q = (
         select(
-            Message,
+            msg_columns,
             MessageContent.body,
             Transaction.compute_exit_code,
             Transaction.action_result_code,
@@ -248,9 +307,28 @@ async def handle_nominator_pool(
     # q = q.distinct(Message.created_lt)
     q = q.order_by(Message.created_lt)
 
+    # only comments (deposit/withdraw) and recover_stake_ok from elector
+    # are parsed, so the rest is not even fetched
     query_msgs_to_pool = q.filter(
         Message.destination == pool_address_str, 
-        Message.direction == "in"
+        Message.direction == "in",
+        or_(
+            Message.opcode == OP_COMMENT,
+            and_(
+                Message.opcode.in_(RECOVER_STAKE_OK_OPCODES),
+                Message.source == ELECTOR_ADDR,
+            ),
+        ),
+        # and only from successful transactions
+        Transaction.compute_exit_code == 0,
+        Transaction.compute_success.is_(True),
+        or_(
+            Transaction.action_result_code.is_(None),
+            and_(
+                Transaction.action_result_code == 0,
+                Transaction.action_success.is_(True),
+            ),
+        ),
     )
     
     query_msgs_from_pool = q.filter(
@@ -258,35 +336,40 @@ async def handle_nominator_pool(
         Message.direction == "out"
     )
 
-    res_to_pool = await origin_conn.execute(query_msgs_to_pool)
-    msgs_to_pool = res_to_pool.all()
+    # pool's existing subaccounts, used when writing the bookings below
+    query_subaccounts = (
+        select(SubAccount, Nominator)
+        .select_from(SubAccount)
+        .join(Nominator, Nominator.subaccount_id == SubAccount.subaccount_id)
+        .filter(SubAccount.parent_account_id == pool_id_in_accouts)
+    )
 
-    res_from_pool = await origin_conn.execute(query_msgs_from_pool)
-    msgs_from_pool = res_from_pool.all()
+    # independent reads on the origin and result dbs, run them together
+    res_to_pool, res_subaccounts = await asyncio.gather(
+        origin_conn.execute(query_msgs_to_pool),
+        result_conn.execute(query_subaccounts),
+    )
+    msgs_to_pool = res_to_pool.all()
+    existing_subaccounts = res_subaccounts.all()
 
     bookings = []
     withdrawal_requests = {}
 
     class MsgAndSeqno(NamedTuple):
-        msg: Message
+        msg: Row
         block_seqno: int
 
     def muldiv(value, num, denom):
         return int((value * num) / denom)
 
     async def process_recover_stake(args: MsgAndSeqno):
-        assert (  # came from elector
-            args.msg.source
-            == "-1:3333333333333333333333333333333333333333333333333333333333333333"
-        )
+        assert args.msg.source == ELECTOR_ADDR  # filtered in query
 
         wc = -1
         shard = -9223372036854775808
         prev_block_seqno = args.block_seqno - 5  # 5 blocks before
 
-        q = select(Block).filter(Block.seqno == prev_block_seqno, Block.workchain == wc)
-        res = await origin_conn.execute(q)
-        block = res.scalar()
+        block = mc_blocks.get(prev_block_seqno)
         if not block:
             logger.info("No block at %s" % prev_block_seqno)
             return
@@ -314,7 +397,7 @@ async def handle_nominator_pool(
         _nominators_dict = HashMap.parse(
             dict_cell=nominators_before.begin_parse(),
             key_length=256,
-            key_deserializer=addr_hash_wc0_parse,
+            key_deserializer=addr_hash_wc0_raw_parse,
             value_deserializer=nominator_value_parse,
         )
         if not _nominators_dict:
@@ -339,12 +422,12 @@ async def handle_nominator_pool(
             his_reward = muldiv(nominators_reward, balance, total_nominators_balance)            
             if not his_reward:
                 continue
-            # logger.debug(f"Adding nominator income {his_reward} for {nominator.to_str(False).upper()} in pool {pool_address_str} at {args.msg.created_at}")
+            # logger.debug(f"Adding nominator income {his_reward} for {nominator} in pool {pool_address_str} at {args.msg.created_at}")
             bookings.append(
                 {
                     "lt": args.msg.created_lt,
                     "utime": args.msg.created_at,
-                    "subaccount_address": nominator.to_str(False).upper(),
+                    "subaccount_address": nominator,
                     "debit": 0,
                     "credit": his_reward,
                     "type": "nominator_income",
@@ -354,54 +437,48 @@ async def handle_nominator_pool(
 
     incomes_to_process = []
     for msg, body, exit_code, action_code, compute_success, action_success, bounce_type, block_seqno in msgs_to_pool:
-        # logger.debug(f"     new tx (to) with lt {msg.created_lt} at {msg.created_at}")
-        
-        if exit_code != 0 or (action_code and action_code != 0):
-            logger.debug(f"Failed tx: exit_code={exit_code}, action_code={action_code} at {msg.created_lt}")
-            continue
-        
-        if not compute_success or (action_code is not None and not action_success):
-            logger.debug(f"Transaction not successful: compute_success={compute_success}, action_success={action_success} at {msg.created_lt}")
-            continue
+        lt, at, src, val = msg.created_lt, msg.created_at, msg.source, msg.value
+        # logger.debug(f"     new tx (to) with lt {lt} at {at}")
+        # failed transactions are filtered in query
 
-        body_boc = Cell.from_boc(body)[0].begin_parse()
-        try:
-            op = body_boc.load_uint(32)
-        except:
-            continue
-        if op == 0:
-            try:
-                first_letter = chr(body_boc.load_uint(8))[0]
-            except:
-                continue
-            if first_letter == "d":
+        op, first_byte = parse_body_op(body)
+        if op == OP_COMMENT:
+            if first_byte == COMMENT_DEPOSIT:
                 bookings.append(
                     {
-                        "lt": msg.created_lt,
-                        "utime": msg.created_at,
-                        "subaccount_address": msg.source,
+                        "lt": lt,
+                        "utime": at,
+                        "subaccount_address": src,
                         "debit": 0,
-                        "credit": msg.value - 10**9,
+                        "credit": val - 10**9,
                         "type": "nominator_deposit",
                     }
                 )
                 logger.info(
                     "Deposit %s at %s for %s on %s"
-                    % (nanostr(msg.value), msg.created_at, msg.source, pool_address_str)
+                    % (nanostr(val), at, src, pool_address_str)
                 )
 
-            elif first_letter == "w":
-                if msg.source not in withdrawal_requests:
-                    withdrawal_requests[msg.source] = []
-                withdrawal_requests[msg.source].append(msg.created_at)
+            elif first_byte == COMMENT_WITHDRAW:
+                if src not in withdrawal_requests:
+                    withdrawal_requests[src] = []
+                withdrawal_requests[src].append(at)
                 logger.info(
                     "Withdraw reqest at %s from %s on %s"
-                    % (msg.created_at, msg.source, pool_address_str)
+                    % (at, src, pool_address_str)
                 )
 
-        elif op == 0xF96F7324:  # recover_stake_ok (i.e. income)
+        elif op == OP_RECOVER_STAKE_OK:  # recover_stake_ok (i.e. income)
             incomes_to_process.append(MsgAndSeqno(msg, block_seqno))
 
+    # blocks for all incomes in one query instead of one per income,
+    # so process_recover_stake only talks to the lite server
+    mc_blocks = {}
+    if incomes_to_process:
+        mc_blocks = await get_mc_blocks(
+            origin_conn, list({m.block_seqno - 5 for m in incomes_to_process})
+        )
+
     async with aiometer.amap(
         process_recover_stake,
         incomes_to_process,
@@ -410,12 +487,16 @@ async def handle_nominator_pool(
     ) as results:
         pass
 
-    for msg, body, exit_code, action_code, compute_success, action_success, bounce_type, block_seqno in msgs_from_pool:
+    # outgoing messages are the bulk of a pool's history; stream them,
+    # origin_conn has no other queries running by now
+    msgs_from_pool = stream(origin_conn, query_msgs_from_pool)
+    async for msg, body, exit_code, action_code, compute_success, action_success, bounce_type, block_seqno in msgs_from_pool:
+        lt, at, src, dst, val = msg.created_lt, msg.created_at, msg.source, msg.destination, msg.value
         # logger.debug(
-        #     f"     new tx (from pool) with lt {msg.created_lt} at {msg.created_at}"
+        #     f"     new tx (from pool) with lt {lt} at {at}"
         # )
         # pool sends withdrawals in bounceable mode
-        if not msg.destination.startswith("0:"):
+        if not dst.startswith("0:"):
             continue
             
         # bounce = enum ('negfunds', 'nofunds', 'ok')
@@ -424,55 +505,55 @@ async def handle_nominator_pool(
             # continue
 
         # and it's more than 1 TON
-        if msg.value < 10**9:
-            logger.debug(f"Less than 1 TON ({nanostr(msg.value)}), skip")
+        if val < 10**9:
+            logger.debug(f"Less than 1 TON ({nanostr(val)}), skip")
             continue
         # and without body (empty cell). excesses will have op
         if body != "te6cckEBAQEAAgAAAEysuc0=":
             logger.debug(
-                f"Non-empty body (value {nanostr(msg.value)}) (body {body}), skip"
+                f"Non-empty body (value {nanostr(val)}) (body {body}), skip"
             )
             continue
 
-        if not msg.destination in withdrawal_requests:
-            logger.debug(f"No requests from {msg.destination}, but fine")
-            withdrawal_requests[msg.destination] = [msg.created_at]
+        if not dst in withdrawal_requests:
+            logger.debug(f"No requests from {dst}, but fine")
+            withdrawal_requests[dst] = [at]
             # continue
 
-        # search for withdrawal request max 36 hours ago (2 rounds)
-        min_at = msg.created_at - 36 * 3600
-        max_at = msg.created_at
-        for req_at in withdrawal_requests[msg.destination]:
-            if req_at > min_at and req_at <= max_at:
-                break
-        else:
-            logger.debug(f"No requests from {msg.destination} in last 36 hours, skip")
+        # search for withdrawal request max 36 hours ago (2 rounds).
+        # requests are appended in lt order, so bisect instead of a scan
+        min_at = at - 36 * 3600
+        max_at = at
+        requests_at = withdrawal_requests[dst]
+        i = bisect_right(requests_at, min_at)
+        if i == len(requests_at) or requests_at[i] > max_at:
+            logger.debug(f"No requests from {dst} in last 36 hours, skip")
             continue
 
         # if found:
         logger.info(
             "Found withdrawal msg from pool %s, amount %s, receiver %s at %s"
-            % (msg.source, msg.value, msg.destination, msg.created_at)
+            % (src, val, dst, at)
         )
 
         bookings.append(
             {
-                "lt": msg.created_lt,
-                "utime": msg.created_at,
-                "subaccount_address": msg.destination,
+                "lt": lt,
+                "utime": at,
+                "subaccount_address": dst,
                 "debit": 10**7, # 0.01 TON fwd fee
                 "credit": 0,
                 "type": "nominator_withdrawal_fwd_fee",
             }
         )
-        logger.info(f"Added 0.01 TON fwd fee record for {msg.destination}")
+        logger.info(f"Added 0.01 TON fwd fee record for {dst}")
 
         bookings.append(
             {
-                "lt": msg.created_lt,
-                "utime": msg.created_at,
-                "subaccount_address": msg.destination,
-                "debit": msg.value,
+                "lt": lt,
+                "utime": at,
+                "subaccount_address": dst,
+                "debit": val,
                 "credit": 0,
                 "type": "nominator_withdrawal",
             }
@@ -484,115 +565,110 @@ async def handle_nominator_pool(
     # now we have complete bookings and we'll insert all of them + nominator in db
 
     # first, create all subaccounts for all nominators
-    q = (
-        select(SubAccount, Nominator)
-        .select_from(SubAccount)
-        .join(Nominator, Nominator.subaccount_id == SubAccount.subaccount_id)
-        .filter(SubAccount.parent_account_id == pool_id_in_accouts)
-    )
-    res = await result_conn.execute(q)
-    existing_subaccounts = res.all()
 
-    all_subaccounts = {}  # including new below
+    all_subaccounts = {}  # owner -> subaccount_id, nominator (None if new)
     for sub in existing_subaccounts:
         all_subaccounts[sub[0].owner] = {
-            "subaccount": sub[0],
+            "subaccount_id": sub[0].subaccount_id,
             "nominator": sub[1],
         }
 
-    # update active nominators
-    new_active_nominators = []
+    # update active nominators, collecting the new ones
+    new_nominators = {}  # owner -> (balance, pending_balance)
+    active_nominators = set()
     if nominators_dict:
-        for nominator, (balance, pending_balance) in nominators_dict.items():
-            nominator_raw = nominator.to_str(False).upper()
-            if not nominator_raw in all_subaccounts:
-                new_subaccount = SubAccount(
-                    owner=nominator_raw,
-                    subaccount_type="pool_nominator",
-                    parent_account_id=pool_id_in_accouts,
-                )
-                result_conn.add(new_subaccount)
-                await result_conn.flush()  # for subaccount_id
-
-                new_nominator = Nominator(
-                    subaccount_id=new_subaccount.subaccount_id,
-                    balance=balance,
-                    pending_balance=pending_balance,
-                )
-                result_conn.add(new_nominator)  # no flush here
-
-                all_subaccounts[nominator_raw] = {
-                    "subaccount": new_subaccount,
-                    "nominator": new_nominator,
-                }
+        for nominator_raw, (balance, pending_balance) in nominators_dict.items():
+            active_nominators.add(nominator_raw)
+            if nominator_raw in all_subaccounts:
+                existing = all_subaccounts[nominator_raw]["nominator"]
+                existing.balance = balance
+                existing.pending_balance = pending_balance
             else:
-                # update data
-                all_subaccounts[nominator_raw]["nominator"].balance = balance
-                all_subaccounts[nominator_raw][
-                    "nominator"
-                ].pending_balance = pending_balance
-
-            new_active_nominators.append(nominator.to_str(False).upper())
+                new_nominators[nominator_raw] = (balance, pending_balance)
 
     # make old active nominators inactive
-    for nominator_addr in all_subaccounts:
-        if nominator_addr not in new_active_nominators:
-            all_subaccounts[nominator_addr]["nominator"].balance = 0
-            all_subaccounts[nominator_addr]["nominator"].pending_balance = 0
+    for nominator_addr, sub in all_subaccounts.items():
+        if nominator_addr not in active_nominators:
+            sub["nominator"].balance = 0
+            sub["nominator"].pending_balance = 0
 
-    # create new nominators
+    # nominators seen only in bookings are new and inactive
     for record in bookings:
-        if not record["subaccount_address"] in all_subaccounts:
-            new_subaccount = SubAccount(
-                owner=record["subaccount_address"],
-                subaccount_type="pool_nominator",
-                parent_account_id=pool_id_in_accouts,
+        if record["subaccount_address"] not in all_subaccounts:
+            new_nominators.setdefault(record["subaccount_address"], (0, 0))
+
+    # create new subaccounts and nominators with two multi-row inserts
+    if new_nominators:
+        res = await result_conn.execute(
+            insert(SubAccount)
+            .values(
+                [
+                    {
+                        "owner": owner,
+                        "subaccount_type": "pool_nominator",
+                        "parent_account_id": pool_id_in_accouts,
+                    }
+                    for owner in new_nominators
+                ]
             )
-            result_conn.add(new_subaccount)
-            await result_conn.flush()
-            new_nominator = Nominator(
-                subaccount_id=new_subaccount.subaccount_id,
-                balance=0,
-                pending_balance=0,
+            .returning(SubAccount.owner, SubAccount.subaccount_id)
+        )
+        new_ids = dict(res.all())
+        await result_conn.execute(
+            insert(Nominator).values(
+                [
+                    {
+                        "subaccount_id": new_ids[owner],
+                        "balance": balance,
+                        "pending_balance": pending_balance,
+                    }
+                    for owner, (balance, pending_balance) in new_nominators.items()
+                ]
             )
-            result_conn.add(new_nominator)
-            all_subaccounts[record["subaccount_address"]] = {
-                "subaccount": new_subaccount,
-                "nominator": new_nominator,
-            }
+        )
+        for owner, subaccount_id in new_ids.items():
+            all_subaccounts[owner] = {"subaccount_id": subaccount_id, "nominator": None}
 
-    # insert bookings and subaccount nominators
+    # insert bookings (changed nominators are flushed with the commit)
+    hashed_bookings = {}  # hash -> record, keeps the first of duplicates
     for record in bookings:
-        result_conn.add(all_subaccounts[record["subaccount_address"]]["subaccount"])
-        result_conn.add(all_subaccounts[record["subaccount_address"]]["nominator"])
-
-        subaccount_id = all_subaccounts[record["subaccount_address"]][
-            "subaccount"
-        ].subaccount_id
+        subaccount_id = all_subaccounts[record["subaccount_address"]]["subaccount_id"]
 
         record["account_id"] = pool_id_in_accouts
         record["subaccount_id"] = subaccount_id
         record_hash = sha256(json.dumps(record, sort_keys=True).encode())
         record_hash = base64.b64encode(record_hash.digest()).decode("ascii")
+        hashed_bookings.setdefault(record_hash, record)
 
+    # one query for the already existing bookings instead of one per record
+    existing_hashes = set()
+    if hashed_bookings:
         res = await result_conn.execute(
-            select(Booking).filter_by(booking_hash=record_hash)
+            select(Booking.booking_hash).filter(
+                Booking.booking_hash.in_(hashed_bookings.keys())
+            )
         )
-        if res.scalar():  # already exists
-            continue
+        existing_hashes = set(res.scalars())
 
-        booking = Booking(
-            booking_hash=record_hash,
-            # account_id=pool_id_in_accouts,
-            subaccount_id=subaccount_id,
-            booking_lt=record["lt"],
-            booking_utime=record["utime"],
-            booking_type=record["type"],
-            credit=record["credit"],
-            debit=record["debit"],
+    new_bookings = []
+    for record_hash, record in hashed_bookings.items():
+        if record_hash in existing_hashes:
+            continue
+        new_bookings.append(
+            {
+                "booking_hash": record_hash,
+                "subaccount_id": record["subaccount_id"],
+                "booking_lt": record["lt"],
+                "booking_utime": record["utime"],
+                "booking_type": record["type"],
+                "credit": record["credit"],
+                "debit": record["debit"],
+            }
         )
-        result_conn.add(booking)
         logger.debug(f"Added booking {record['type']} for {record['subaccount_address']} at {record['utime']}, debit: {record['debit']}, credit: {record['credit']}")
+
+    if new_bookings:
+        await bulk_copy(result_conn, Booking, new_bookings, list(new_bookings[0]))
     await result_conn.commit()
 
 
@@ -2,7 +2,8 @@
 
 # from loguru import logger
 # from pytoniq.liteclient import LiteClient
-# from sqlalchemy import delete, select
+# from sqlalchemy import delete
+# from sqlalchemy.dialects.postgresql import insert
 
 # from contracts_db.database import Wallet
 # from handlers.handler_types import DBSession
@@ -21,9 +22,7 @@
 #         async def delete_wallet():
 #             query = delete(Wallet).filter_by(account=addr)
 #             await result_conn.execute(query)
-
-#         find_res = await result_conn.execute(select(Wallet).filter_by(account=addr))
-#         wallet = find_res.scalar()
+#             await result_conn.commit()
 
 #         try:
 #             account = await lite_client.get_account_state(addr)
@@ -45,8 +44,10 @@
 #         public_key = base64.b64encode(public_key).decode()
 #         # logger.debug(f"Wallet V3R2 {addr} has public key {public_key}")
 
-#         if not wallet:
-#             wallet = Wallet(
+#         # single round-trip upsert, no select of the existing row
+#         query = (
+#             insert(Wallet)
+#             .values(
 #                 account=addr,
 #                 public_key=public_key,
 #                 subwallet_id=subwallet_id,
@@ -54,11 +55,12 @@
 #                 version="v3r2",
 #                 seqno=seqno,
 #             )
-#         else:
-#             wallet.balance = balance
-#             wallet.seqno = seqno
-
-#         result_conn.add(wallet)
+#             .on_conflict_do_update(
+#                 index_elements=[Wallet.account],
+#                 set_={"balance": balance, "seqno": seqno},
+#             )
+#         )
+#         await result_conn.execute(query)
 #         await result_conn.commit()
 
 
@@ -2,19 +2,26 @@ import asyncio
 import functools
 import json
 import os
-import sys
+from hashlib import sha256
 from time import time
+from typing import Callable
 from progress.bar import IncrementalBar
 
-import aiometer
+import uvloop
 from dotenv import load_dotenv
 from loguru import logger
 from pytoniq.liteclient import LiteClient
-from sqlalchemy import select, text
+from sqlalchemy import String, any_, bindparam, func, select, text, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.schema import CreateSchema
 
 from contracts_db.database import Base as ContractsBase
-from core.connections import SessionMaker_Origin, SessionMaker_Result, engine_result
+from core.connections import (
+    SessionMaker_Origin,
+    SessionMaker_Result,
+    engine_origin,
+    engine_result,
+)
 from core.localdb import localdb
 from core.processors import CallHandlerArgs, call_handler
 from core.settings import settings
@@ -22,7 +29,7 @@ from handlers import handlers as contract_handlers
 from handlers.handler_types import HandlerArgs
 from mainnet_db.database import LatestAccountState
 from pytoniq_core.boc.hashmap import HashMap
-from pytoniq_core.boc import Address, Cell, Slice
+from pytoniq_core.boc import Slice
 from core.utils import addr_hash_wc0_parse
 from handlers.new_nominator_pool import parse_pool
 
@@ -31,25 +38,40 @@ load_dotenv()
 
 
 # use LS to get contracts' data
-with open(settings.config_path) as config_file:
-    config = json.loads(config_file.read())
-lite_client = LiteClient.from_config(config, timeout=30)  # i=2 for mainnet config
+@functools.cache
+def get_config() -> dict:
+    with open(settings.config_path) as config_file:
+        return json.load(config_file)
 
-print(contract_handlers.keys())
 
-PERIOD = 30
-CHUNK_SIZE = 5
+@functools.cache
+def get_client() -> LiteClient:
+    return LiteClient.from_config(get_config(), timeout=30)  # i=2 for mainnet config
 
 
-@logger.catch()
-async def run():
-    localdb.read()
-
-    contract_types = contract_handlers.keys()
-    logger.warning(
-        f"Start handling {len(contract_types)} contract types from second {localdb.index_second}."
-    )
+print(contract_handlers.keys())
 
+PERIOD = 30
+PAGE_SIZE = 1000  # accounts fetched from origin db at once
+MAX_PER_SECOND = 3  # handlers started per second, spares the lite server
+LS_PROBE_TIMEOUT = 2
+LS_MAX_BACKOFF = 60
+
+# frozen once, bound as a single array param so the query text stays
+# the same every cycle and asyncpg reuses its prepared statement
+CONTRACT_TYPES = tuple(contract_handlers.keys())
+# same predicate as literal sql, shared by the partial origin index and the
+# query that should use it: a generic plan for "= ANY($1)" can't prove the
+# index's WHERE clause, so the hashes must be inlined when that index is on
+KNOWN_CODE_HASHES_SQL = "code_hash = ANY (ARRAY[{}])".format(
+    ", ".join(f"'{h}'" for h in sorted(CONTRACT_TYPES))
+)
+
+
+async def fetch_accounts_page(
+    from_second: int, after: tuple[int, str] | None = None
+) -> list:
+    """Next page of accounts to index, ordered by (timestamp, account)."""
     async with SessionMaker_Origin() as origin_db:
         query = (
             select(
@@ -59,99 +81,166 @@ async def run():
                 LatestAccountState.data_hash,
                 LatestAccountState.timestamp,
             )
-            .filter(LatestAccountState.code_hash.in_(contract_types))
-            .filter(LatestAccountState.timestamp > localdb.index_second)
-            .order_by(LatestAccountState.timestamp)
+            .filter(
+                text(KNOWN_CODE_HASHES_SQL)
+                if settings.create_origin_index
+                else LatestAccountState.code_hash
+                == any_(
+                    bindparam(
+                        "code_hashes", value=list(CONTRACT_TYPES), type_=ARRAY(String)
+                    )
+                )
+            )
+            .filter(LatestAccountState.timestamp > from_second)
+            .order_by(LatestAccountState.timestamp, LatestAccountState.account)
+            .limit(PAGE_SIZE)
             # .filter(  # DEBUG
             #     LatestAccountState.account
             #     == "-1:C3927B436211AF4556703A6928BA9232B78CC8AA2EF89563A42542411DB4830E"
             # )
         )
+        if settings.shards_count > 1:
+            # disjoint share of accounts for this indexer process
+            # (masked, not abs(): abs(-2^31) is out of int4 range)
+            query = query.filter(
+                func.hashtext(LatestAccountState.account).op("&")(0x7FFFFFFF)
+                % settings.shards_count
+                == settings.shard_index
+            )
+        if after:
+            # keyset pagination: continue right after the last seen row
+            query = query.filter(
+                tuple_(LatestAccountState.timestamp, LatestAccountState.account)
+                > after
+            )
 
         res = await origin_db.execute(query)
-        all_accounts = res.all()
-        logger.warning(f"Found {len(all_accounts)} accounts of described types.")
-
-    # tasks = []  # gathering buffer
-    processing_timestamp = 0  # in case of error - save chunk's timestamp
-    argss = []
-    for i, (account, balance, code_hash, data_hash, timestamp) in enumerate(
-        all_accounts
-    ):
-        # tasks.append(
-        #     call_handler(
-        #         code_hash,
-        #         SessionMaker_Origin,
-        #         SessionMaker_Result,
-        #         account,
-        #         balance,
-        #         data_hash,
-        #         lite_client,
-        #         localdb.index_second,
-        #     )
-        # )
-        argss.append(
-            CallHandlerArgs(
-                handler_args=HandlerArgs(
-                    origin_db=SessionMaker_Origin,
-                    result_db=SessionMaker_Result,
-                    address=account,
-                    balance=balance,
-                    data_hash=data_hash,
-                    lite_client=lite_client,
-                    utime=localdb.index_second,
-                ),
-                code_hash=code_hash,
-            )
-        )
+        return res.all()
+
+
+async def worker(
+    queue: asyncio.Queue,
+    errors: list[Exception],
+    on_done: Callable[[], None],
+):
+    """Persistent handler task, takes call args from the queue until cancelled."""
+    while True:
+        args = await queue.get()
+        try:
+            await call_handler(args)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.task_done()
+            on_done()
+
+
+async def ensure_lite_alive(lite_client: LiteClient):
+    """Cheap probe before the cycle, reconnects with backoff if LS is gone."""
+    try:
+        await asyncio.wait_for(lite_client.get_masterchain_info(), LS_PROBE_TIMEOUT)
+        return
+    except Exception as e:
+        logger.warning(f"Lite client is not responding: {e}. Reconnecting")
+
+    delay = 1
+    while True:
+        try:
+            await lite_client.reconnect()
+            return
+        except Exception as e:
+            logger.error(f"Failed to reconnect lite client: {e}, retry in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LS_MAX_BACKOFF)
+
+
+@logger.catch()
+async def run():
+    localdb.read()
+    lite_client = get_client()
+    await ensure_lite_alive(lite_client)
+    # handlers look for messages since the start of the cycle, so localdb
+    # is moved forward only once the whole cycle is done
+    from_second = localdb.index_second
 
-        # if not processing_timestamp:
-        #     processing_timestamp = timestamp - 1
-
-        # if len(tasks) >= CHUNK_SIZE or i == len(all_accounts) - 1:
-        #     try:
-        #         pass
-        #     except Exception as e:
-        #         logger.error(
-        #             "Something went wrong on indexing around timestamp",
-        #             processing_timestamp,
-        #         )
-        #         logger.error(f"Saving second {processing_timestamp} to local db")
-        #         localdb.index_second = processing_timestamp
-        #         localdb.write()
-        #         processing_timestamp = 0
-        #         raise e
-        #     await asyncio.gather(*tasks)
-        #     tasks = []
-        #     processing_timestamp = 0
-
-    # await aiometer.run_on_each(call_handler, argss, max_at_once=CHUNK_SIZE)
-
-    
-    # the bar will be in stdout only
-    bar = IncrementalBar(f'Indexing from {localdb.index_second}', max=len(argss))
+    logger.warning(
+        f"Start handling {len(CONTRACT_TYPES)} contract types from second {localdb.index_second}."
+    )
+    if settings.shards_count > 1:
+        logger.warning(f"Shard {settings.shard_index} of {settings.shards_count}.")
+
+    # the bar will be in stdout only. its max grows with every page
+    bar = IncrementalBar(f'Indexing from {localdb.index_second}', max=0)
 
     done = 0
     started_at = time()
-    async with aiometer.amap(
-        call_handler,
-        argss,
-        max_at_once=9,
-        max_per_second=3,
-    ) as results:
-        async for _ in results:
-            done += 1
-            elapsed = time() - started_at
-            speed = done / elapsed
-            bar.next()
-            logger.info(f"Processed {done}/{len(all_accounts)}, {speed:.2f}/sec")
+
+    def on_done():
+        nonlocal done
+        done += 1
+        elapsed = time() - started_at
+        speed = done / elapsed
+        bar.next()
+        logger.info(f"Processed {done}/{bar.max}, {speed:.2f}/sec")
+
+    # a slow account only holds its own worker, the rest keep going
+    queue = asyncio.Queue(maxsize=settings.max_at_once * 4)
+    errors = []
+    workers = [
+        asyncio.create_task(worker(queue, errors, on_done))
+        for _ in range(settings.max_at_once)
+    ]
+
+    last_seen = None  # (timestamp, account) of the last fetched row
+    try:
+        while True:
+            # handlers start on the first page instead of waiting for the whole scan
+            page = await fetch_accounts_page(from_second, last_seen)
+            if not page:
+                break
+            last_seen = (page[-1].timestamp, page[-1].account)
+            logger.warning(f"Found {len(page)} accounts of described types.")
+            bar.max += len(page)
+
+            for account, balance, code_hash, data_hash, timestamp in page:
+                await queue.put(
+                    CallHandlerArgs(
+                        handler_args=HandlerArgs(
+                            origin_db=SessionMaker_Origin,
+                            result_db=SessionMaker_Result,
+                            address=account,
+                            balance=balance,
+                            data_hash=data_hash,
+                            lite_client=lite_client,
+                            utime=from_second,
+                        ),
+                        code_hash=code_hash,
+                    )
+                )
+                await asyncio.sleep(1 / MAX_PER_SECOND)
+
+            await queue.join()
+            if errors:
+                # in case of error - save the cycle's start: handlers of this
+                # and later pages need their messages since from_second
+                processing_timestamp = from_second
+                logger.error(
+                    f"Something went wrong on indexing around timestamp {processing_timestamp}: {errors[0]}"
+                )
+                logger.error(f"Saving second {processing_timestamp} to local db")
+                localdb.index_second = processing_timestamp
+                localdb.write()
+                raise errors[0]
+    finally:
+        for task in workers:
+            task.cancel()
 
     bar.finish()
 
-    if all_accounts:
-        last_timestamp = all_accounts[-1][4]
+    if last_seen:
+        last_timestamp = last_seen[0]
         localdb.index_second = last_timestamp
-        localdb.write()
+        await asyncio.to_thread(localdb.write)
         logger.warning(
             f"Finished index cycle and saved second {localdb.index_second} to local db"
         )
@@ -166,16 +255,91 @@ async def connect_db():
         await conn.execute(CreateSchema("account_types", if_not_exists=True))
         await conn.execute(CreateSchema("subaccount_types", if_not_exists=True))
         await conn.run_sync(ContractsBase.metadata.create_all)
+        await ensure_unique_accounts(conn)
+
+
+async def ensure_unique_accounts(conn):
+    """
+    Handlers upsert accounts with ON CONFLICT (account). create_all only
+    adds the unique constraint on new dbs, so on older ones merge the
+    duplicate rows into the oldest and add a unique index by hand.
+    """
+    exists = await conn.scalar(text("SELECT to_regclass('accounts_account_key')"))
+    if exists:
+        return
+    logger.warning("Adding unique index on accounts.account")
+    # pool data of duplicates is rewritten on the next handler run
+    await conn.execute(text(
+        "DELETE FROM account_types.nominator_pools p USING accounts a, accounts b "
+        "WHERE p.account_id = a.account_id "
+        "AND a.account = b.account AND a.account_id > b.account_id"
+    ))
+    await conn.execute(text(
+        "UPDATE subaccounts s SET parent_account_id = d.keep_id "
+        "FROM (SELECT account_id, min(account_id) OVER (PARTITION BY account) AS keep_id "
+        "FROM accounts) d "
+        "WHERE s.parent_account_id = d.account_id AND d.account_id <> d.keep_id"
+    ))
+    await conn.execute(text(
+        "DELETE FROM accounts a USING accounts b "
+        "WHERE a.account = b.account AND a.account_id > b.account_id"
+    ))
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS accounts_account_key ON accounts (account)"
+    ))
+
+
+async def create_origin_index():
+    """
+    Partial index on latest_account_states restricted to the handled code
+    hashes, so it stays small. Its name depends on the set of hashes,
+    so a new one is built whenever handlers change (drop the old one by hand).
+    An alternative to latest_account_states_index_2 (same keys, whole
+    table): with this one in place that one can be dropped.
+    """
+    suffix = sha256("".join(sorted(CONTRACT_TYPES)).encode()).hexdigest()[:8]
+    name = f"las_partial_known_ts_{suffix}"
+    try:
+        # concurrently can't run inside a transaction
+        async with engine_origin.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            valid = (
+                await conn.execute(
+                    text(
+                        "SELECT i.indisvalid FROM pg_index i "
+                        "JOIN pg_class c ON c.oid = i.indexrelid "
+                        "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+                    ),
+                    {"name": name},
+                )
+            ).scalar()
+            if valid is False:
+                # left behind by a failed concurrent build, IF NOT EXISTS would skip it
+                logger.warning(f"Origin index {name} is invalid, rebuilding")
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            if not valid:
+                await conn.execute(
+                    text(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                        f"ON latest_account_states (timestamp, code_hash) "
+                        f"WHERE {KNOWN_CODE_HASHES_SQL}"
+                    )
+                )
+        logger.warning(f"Origin index {name} is ready")
+    except Exception as e:
+        logger.error(f"Failed to create origin index: {e}")
 
 
 async def main():
-    global lite_client
     logger.critical(
         "Starting Smart Contracts Indexer from %s db into %s db"
         % (settings.db_origin_name, settings.db_result_name)
     )
 
     await connect_db()
+    if settings.create_origin_index:
+        await create_origin_index()
+    lite_client = get_client()
     await lite_client.connect()
 
     # res = await lite_client.run_get_method(
@@ -231,4 +395,4 @@ if __name__ == "__main__":
         rotation="01:00",
         compression="gz"
     )
-    asyncio.run(main())
+    uvloop.run(main())
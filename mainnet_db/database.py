@@ -1,10 +1,11 @@
 import asyncio
 import logging
 from dataclasses import dataclass
-from time import sleep
+from time import time
 from typing import Any, Dict, List, Optional
 
 from sqlalchemy import (
+    DDL,
     BigInteger,
     Boolean,
     Enum,
@@ -14,10 +15,11 @@ from sqlalchemy import (
     Integer,
     Numeric,
     String,
-    create_engine,
+    bindparam,
+    event,
 )
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.future import select
 from sqlalchemy.orm import (
@@ -26,68 +28,63 @@ from sqlalchemy.orm import (
     declarative_base,
     mapped_column,
     relationship,
-    sessionmaker,
 )
 from sqlalchemy.schema import ForeignKeyConstraint
-from sqlalchemy_utils import create_database, database_exists
 
-from core.settings import Settings
+from core.connections import make_engine
+from core.settings import Settings, get_settings
 
 logger = logging.getLogger(__name__)
 
 MASTERCHAIN_INDEX = -1
 MASTERCHAIN_SHARD = -9223372036854775808
 
-settings = Settings()
+settings = get_settings()
 
 
 # async engine
-def get_engine(settings: Settings):
-    # logger.critical(settings.origin_dsn)
-    engine = create_async_engine(
-        settings.origin_dsn,
-        pool_size=128,
-        max_overflow=24,
-        pool_timeout=128,
-        echo=False,
-    )
-    return engine
+def get_engine(settings: Optional[Settings] = None):
+    """Origin db engine, see make_engine for the pgbouncer modes."""
+    settings = settings or get_settings()
+    return make_engine(settings.origin_dsn, pool_size=20, max_overflow=10, settings=settings)
 
 
 engine = get_engine(settings)
 SessionMaker = async_sessionmaker(bind=engine)
 
 
-# sync engine
-def get_sync_engine(settings: Settings):
-    dsn = settings.origin_dsn.replace("+asyncpg", "+psycopg2")
-    # logger.critical(dsn)
-    engine = create_engine(
-        dsn, pool_size=128, max_overflow=24, pool_timeout=128, echo=False
-    )
-    return engine
-
+async def stream(session: AsyncSession, stmt, batch: int = 10_000):
+    """
+    Iterate over rows of a big select through a server-side cursor,
+    holding at most `batch` rows in memory instead of the whole result.
+    Don't run other queries on the same session until it is exhausted.
+    """
+    result = await session.stream(stmt.execution_options(yield_per=batch))
+    async for row in result:
+        yield row
 
-sync_engine = get_sync_engine(settings)
-SyncSessionMaker = sessionmaker(bind=sync_engine)
 
 # database
 Base = declarative_base()
 utils_url = str(engine.url).replace("+asyncpg", "")
 
 
-def init_database(create=False):
-    while not database_exists(utils_url):
+async def init_database(create=False, timeout=30.0):
+    from sqlalchemy_utils import create_database, database_exists
+
+    backoff = 0.01
+    deadline = time() + timeout
+    while not await asyncio.to_thread(database_exists, utils_url):
         if create:
             logger.info("Creating database")
-            create_database(utils_url)
-
-            async def create_tables():
-                async with engine.begin() as conn:
-                    await conn.run_sync(Base.metadata.create_all)
-
-            asyncio.run(create_tables())
-        sleep(0.5)
+            await asyncio.to_thread(create_database, utils_url)
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            continue
+        if time() >= deadline:
+            raise TimeoutError(f"database did not appear in {timeout}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 2.0)
 
 
 # types
@@ -95,6 +92,13 @@ AccountStatus = Enum("uninit", "frozen", "active", "nonexist", name="account_sta
 
 
 # classes
+# The models mirror ton-indexer's schema, which the indexer queries as is:
+# columns, types and keys must match the real tables. Indexes and storage
+# options are physical tuning only. They are created by
+# `python -m mainnet_db.database` and are the DDL to apply to the origin db.
+#
+# account state and message content relationships are lazy='raise': load them explicitly
+# with .options(selectinload(...)) where needed
 class Block(Base):
     __tablename__ = "blocks"
     __table_args__ = (
@@ -232,15 +236,17 @@ class Transaction(Base):
     account_state_before = relationship("AccountState",
                                         foreign_keys=[account_state_hash_before],
                                         primaryjoin="AccountState.hash == Transaction.account_state_hash_before",
+                                        lazy='raise',
                                         viewonly=True)
     account_state_after = relationship("AccountState",
                                        foreign_keys=[account_state_hash_after],
                                        primaryjoin="AccountState.hash == Transaction.account_state_hash_after",
+                                       lazy='raise',
                                        viewonly=True)
     account_state_latest = relationship("LatestAccountState",
                                        foreign_keys=[account],
                                        primaryjoin="LatestAccountState.account == Transaction.account",
-                                       lazy='selectin',
+                                       lazy='raise',
                                        viewonly=True)
     messages: Mapped[List["Message"]] = relationship("Message", back_populates="transaction", viewonly=True)
     trace: Mapped[Optional["Trace"]] = relationship("Trace", foreign_keys=[trace_id], primaryjoin="Transaction.trace_id == Trace.trace_id", viewonly=True)
@@ -314,37 +320,37 @@ class Message(Base):
     message_content = relationship("MessageContent",
                                    foreign_keys=[body_hash],
                                    primaryjoin="Message.body_hash == MessageContent.hash",
+                                   lazy='raise',
                                    viewonly=True)
     init_state = relationship("MessageContent",
                               foreign_keys=[init_state_hash],
                               primaryjoin="Message.init_state_hash == MessageContent.hash",
+                              lazy='raise',
                               viewonly=True)
 
     source_account_state = relationship("LatestAccountState",
                               foreign_keys=[source],
                               primaryjoin="Message.source == LatestAccountState.account",
-                              lazy='selectin',
+                              lazy='raise',
                               viewonly=True)
 
     destination_account_state = relationship("LatestAccountState",
                               foreign_keys=[destination],
                               primaryjoin="Message.destination == LatestAccountState.account",
-                              lazy='selectin',
+                              lazy='raise',
                               viewonly=True)
 
     def __repr__(self):
-        opcode = self.opcode
-        if opcode is not None:
-            if opcode > 0:
-                opcode = hex(opcode)
-            else:
-                opcode = hex(opcode & 0xffffffff)
+        # opcode is stored as signed int32, masking prints it unsigned either way
+        opcode = None if self.opcode is None else f"0x{self.opcode & 0xffffffff:08x}"
 
         return f"Message({self.direction}, {self.msg_hash}, {opcode})"
 
 
 class MessageContent(Base):
     __tablename__ = 'message_contents'
+    # move bodies to TOAST early, see the lz4 compression below
+    __table_args__ = {"postgresql_with": {"toast_tuple_target": 128}}
 
     hash: Mapped[str] = mapped_column(String(44), primary_key=True)
     body: Mapped[str] = mapped_column(String)
@@ -517,15 +523,31 @@ class LatestAccountState(Base):
     balance: Mapped[int] = mapped_column(Numeric)
 
 
+# lz4 (pg14+) decompresses several times faster than the default pglz.
+# best effort: on older servers or builds without lz4 keep pglz instead of
+# failing create_all (EXECUTE, so the statement is only parsed when run)
+event.listen(
+    MessageContent.__table__,
+    "after_create",
+    DDL(
+        "DO $$ BEGIN "
+        "EXECUTE 'ALTER TABLE %(table)s ALTER COLUMN body SET COMPRESSION lz4'; "
+        "EXCEPTION WHEN OTHERS THEN RAISE NOTICE 'lz4 unavailable, keeping pglz'; "
+        "END $$"
+    ),
+)
+
+
 # Indexes
 # Index("blocks_index_1", Block.workchain, Block.shard, Block.seqno)
-Index("blocks_index_2", Block.gen_utime)
+# brin for append-only monotonic columns: a few pages instead of a full btree
+Index("blocks_index_2", Block.gen_utime, postgresql_using="brin", postgresql_with={"pages_per_range": 32})
 Index("blocks_index_3", Block.mc_block_workchain, Block.mc_block_shard, Block.mc_block_seqno)
 Index("blocks_index_4", Block.seqno, postgresql_where=(Block.workchain == -1))
-Index("blocks_index_5", Block.start_lt)
+Index("blocks_index_5", Block.start_lt, postgresql_using="brin", postgresql_with={"pages_per_range": 32})
 
 Index("transactions_index_1", Transaction.block_workchain, Transaction.block_shard, Transaction.block_seqno)
-Index("transactions_index_2", Transaction.account, Transaction.lt)
+Index("transactions_index_2", Transaction.account, Transaction.lt, postgresql_include=["hash", "now", "total_fees"])
 Index("transactions_index_2a", Transaction.account, Transaction.now)
 Index("transactions_index_3", Transaction.now, Transaction.hash)
 Index("transactions_index_4", Transaction.lt, Transaction.hash)
@@ -537,7 +559,7 @@ Index("transactions_index_8", Transaction.mc_block_seqno)
 # Index("messages_index_1", Message.hash)
 Index("messages_index_2", Message.source)
 Index("messages_index_3", Message.destination)
-Index("messages_index_4", Message.created_lt)
+Index("messages_index_4", Message.created_lt, postgresql_using="brin", postgresql_with={"pages_per_range": 32})
 # Index("messages_index_5", Message.created_at)
 # Index("messages_index_6", Message.body_hash)
 # Index("messages_index_7", Message.init_state_hash)
@@ -547,7 +569,7 @@ Index("messages_index_4", Message.created_lt)
 
 # Index("jetton_wallets_index_1", JettonWallet.address)
 Index("jetton_wallets_index_2", JettonWallet.owner)
-Index("jetton_wallets_index_3", JettonWallet.jetton)
+# Index("jetton_wallets_index_3", JettonWallet.jetton)  # covered by index_4
 Index("jetton_wallets_index_4", JettonWallet.jetton, JettonWallet.balance)
 # Index("jetton_wallets_index_4", JettonWallet.code_hash)
 
@@ -570,18 +592,41 @@ Index("nft_collections_index_2", NFTCollection.owner_address)
 # Index("nft_collections_index_3", NFTCollection.code_hash)
 
 # Index("nft_items_index_1", NFTItem.address)
-Index("nft_items_index_2", NFTItem.collection_address)
+# Index("nft_items_index_2", NFTItem.collection_address)  # covered by index_4
 Index("nft_items_index_3", NFTItem.owner_address)
-Index("nft_items_index_4", NFTItem.collection_address, NFTItem.index)
+Index("nft_items_index_4", NFTItem.collection_address, NFTItem.index, postgresql_include=["owner_address"])
 
 # Index("nft_transfers_index_1", NFTTransfer.transaction_hash)
 Index("nft_transfers_index_2", NFTTransfer.nft_item_address)
 Index("nft_transfers_index_3", NFTTransfer.old_owner)
 Index("nft_transfers_index_4", NFTTransfer.new_owner)
 
-async def test():
-    init_database()
+# covering index for the indexer query: index only scan, no heap fetches
+Index(
+    "latest_account_states_index_1",
+    LatestAccountState.code_hash,
+    LatestAccountState.timestamp,
+    postgresql_using="btree",
+    postgresql_include=["account", "balance", "data_hash"],
+)
+# walked in order by the indexer's timestamp-ordered pages; main.create_origin_index
+# builds a smaller partial alternative with the same keys, keep only one of them
+Index("latest_account_states_index_2", LatestAccountState.timestamp, LatestAccountState.code_hash)
+
+# Prebuilt statements for fixed-shape lookups: built once at import instead
+# of on every call. This only saves constructing the select; the compiled
+# cache is keyed on statement structure and would be hit either way
+GET_MC_BLOCKS_BY_SEQNOS = select(Block).where(
+    Block.workchain == MASTERCHAIN_INDEX,
+    Block.seqno.in_(bindparam("seqnos", expanding=True)),
+)
+
+
+async def get_mc_blocks(session: AsyncSession, seqnos: List[int]) -> Dict[int, Block]:
+    res = await session.execute(GET_MC_BLOCKS_BY_SEQNOS, {"seqnos": seqnos})
+    return {block.seqno: block for block in res.scalars()}
 
 
 if __name__ == "__main__":
-    asyncio.run(test())
+    # python -m mainnet_db.database
+    asyncio.run(init_database(create=True))